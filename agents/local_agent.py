@@ -1,15 +1,21 @@
 import aiohttp
-from typing import AsyncGenerator
-import json
+from typing import AsyncGenerator, Optional
+import orjson
 import os
 import sqlite3
 import numpy as np
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
 class LocalAgent:
+    # Ollama API endpoint (default local installation)
+    base_url = "http://localhost:11434"
+    # Embedding model shared by every session's agent (loaded once per process)
+    _shared_embed_model = None
+    # Pooled HTTP session to Ollama shared by every session's agent
+    _shared_session: Optional[aiohttp.ClientSession] = None
+
     def __init__(self):
-        # Ollama API endpoint (default local installation)
-        self.api_url = "http://localhost:11434/api/generate"
+        self.generate_path = "/api/generate"
         # Using Llama 3.2 3B - Meta's latest multilingual model optimized for:
         # - Following instructions
         # - Summarization
@@ -18,10 +24,8 @@ class LocalAgent:
         # Supports: English, German, French, Italian, Portuguese, Hindi, Spanish, and Thai
         self.model = "llama3.2"
         
-        # Initialize embedding model for semantic search
-        self.embed_model = HuggingFaceEmbedding(
-            model_name="sentence-transformers/all-MiniLM-L6-v2"
-        )
+        # Embedding model for semantic search
+        self.embed_model = self._get_embed_model()
         
         # Initialize SQLite database
         self.db_path = "./data/conversations.db"
@@ -37,6 +41,34 @@ class LocalAgent:
 - Use bold and italics for emphasis
 """
 
+    @classmethod
+    def _get_embed_model(cls) -> HuggingFaceEmbedding:
+        """Load the embedding model on first use and reuse it across sessions"""
+        if cls._shared_embed_model is None:
+            cls._shared_embed_model = HuggingFaceEmbedding(
+                model_name="sentence-transformers/all-MiniLM-L6-v2"
+            )
+        return cls._shared_embed_model
+
+    @classmethod
+    def _get_session(cls) -> aiohttp.ClientSession:
+        """Return the Ollama HTTP session shared across sessions, creating it on first use"""
+        if cls._shared_session is None or cls._shared_session.closed:
+            connector = aiohttp.TCPConnector(limit=16, force_close=False, keepalive_timeout=60)
+            cls._shared_session = aiohttp.ClientSession(
+                base_url=cls.base_url,
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=300)
+            )
+        return cls._shared_session
+
+    @classmethod
+    async def close_shared_session(cls):
+        """Close the shared Ollama HTTP session (called once on app shutdown)"""
+        if cls._shared_session is not None and not cls._shared_session.closed:
+            await cls._shared_session.close()
+        cls._shared_session = None
+
     def _init_db(self):
         """Initialize SQLite database with conversations table"""
         with sqlite3.connect(self.db_path) as conn:
@@ -58,7 +90,7 @@ class LocalAgent:
         try:
             # Generate embedding
             embedding = self.embed_model.get_text_embedding(message)
-            embedding_bytes = np.array(embedding).tobytes()
+            embedding_bytes = np.asarray(embedding, dtype=np.float16).tobytes()
             
             # Store in database
             with sqlite3.connect(self.db_path) as conn:
@@ -69,11 +101,19 @@ class LocalAgent:
         except Exception as e:
             print(f"Error storing message: {e}")
 
+    @staticmethod
+    def _decode_embedding(embedding_bytes: bytes, dim: int) -> np.ndarray:
+        """Decode a stored embedding (float16, or float64 for rows stored before the switch)"""
+        dtype = np.float16 if len(embedding_bytes) == dim * np.dtype(np.float16).itemsize else np.float64
+        return np.frombuffer(embedding_bytes, dtype=dtype).astype(np.float32)
+
     def _get_relevant_context(self, session_id: str, current_message: str, max_messages: int = 5):
         """Get most relevant previous messages using semantic search and chronological order"""
         try:
             # Get embedding for current message
-            current_embedding = self.embed_model.get_text_embedding(current_message)
+            current_embedding = np.asarray(
+                self.embed_model.get_text_embedding(current_message), dtype=np.float32
+            )
             
             with sqlite3.connect(self.db_path) as conn:
                 # First, get the most recent messages in chronological order
@@ -91,7 +131,7 @@ class LocalAgent:
                 # Calculate similarities and maintain chronological info
                 messages_with_scores = []
                 for role, message, embedding_bytes, timestamp in recent_messages:
-                    embedding = np.frombuffer(embedding_bytes).reshape(-1)
+                    embedding = self._decode_embedding(embedding_bytes, current_embedding.size)
                     similarity = np.dot(current_embedding, embedding) / (
                         np.linalg.norm(current_embedding) * np.linalg.norm(embedding)
                     )
@@ -179,35 +219,26 @@ If the context is not relevant to the current question, ignore it and answer bas
                 }
             }
             
-            current_response = ""
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.api_url, json=payload) as response:
-                    # Read and process the streaming response
-                    async for line in response.content:
-                        if line:
-                            try:
-                                # Decode and parse the JSON response
-                                chunk = json.loads(line.decode('utf-8'))
-                                # Accumulate response and format
-                                if chunk.get("response"):
-                                    current_response += chunk["response"]
-                                    # Only yield complete sentences or code blocks
-                                    if any(char in current_response for char in ".!?\n```"):
-                                        yield current_response
-                                        current_response = ""
-                            except json.JSONDecodeError:
-                                continue
-                    
-                    # Yield any remaining response
-                    if current_response:
-                        yield current_response
-                    
-                    # Store assistant's complete response
-                    self._store_message(session_id, current_response, "assistant")
-                    
-                    # Cleanup old sessions
-                    self._cleanup_old_sessions()
-                                
+            response_parts = []
+            session = self._get_session()
+            async with session.post(self.generate_path, json=payload) as response:
+                # Forward each token to the client as soon as it arrives
+                async for line in response.content:
+                    if line:
+                        try:
+                            chunk = orjson.loads(line)
+                            if chunk.get("response"):
+                                response_parts.append(chunk["response"])
+                                yield chunk["response"]
+                        except orjson.JSONDecodeError:
+                            continue
+                
+                # Store assistant's complete response
+                self._store_message(session_id, "".join(response_parts), "assistant")
+                
+                # Cleanup old sessions
+                self._cleanup_old_sessions()
+                            
         except Exception as e:
             print(f"Error in LocalAgent streaming: {e}")
             yield f"Error: {str(e)}" 
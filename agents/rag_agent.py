@@ -1,25 +1,80 @@
 import os
-from typing import Dict, List, Optional
+from typing import AsyncGenerator, Dict, List, Optional
 from dotenv import load_dotenv
 import requests
 import mimetypes
 import base64
 import google.generativeai as genai
 from llama_index.core.node_parser import TokenTextSplitter
+from llama_index.core.utils import get_tokenizer
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 import numpy as np
+import torch
 import chromadb
-import uuid
+from chromadb.errors import NotFoundError
+import hashlib
 from llama_parse import LlamaParse
 import asyncio
-import sys
+import functools
+import platform
+import re
 import aiohttp
 import datetime
 
-# Only apply nest_asyncio if we're not using uvloop
-if 'uvloop' not in sys.modules:
-    import nest_asyncio
-    nest_asyncio.apply()
+# Chunks embedded and written to ChromaDB per ingestion step
+INGEST_BATCH_SIZE = 256
+
+# Chunk size limits in tokens
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# Text shorter than this is merged into a neighbouring chunk
+MIN_CHUNK_SIZE = 100
+
+# Files read as plain text without LlamaParse, by extension (host-independent)
+# and by non-text/* MIME type
+PLAIN_TEXT_EXTENSIONS = frozenset({'.txt', '.md', '.markdown', '.py', '.js', '.mjs', '.csv'})
+MARKDOWN_EXTENSIONS = frozenset({'.md', '.markdown'})
+PLAIN_TEXT_MIMES = frozenset({'application/javascript'})
+# text/* types that still need parsing (RTF is markup, not text)
+PARSED_TEXT_MIMES = frozenset({'text/rtf', 'application/rtf'})
+
+# Start of a markdown heading line (LlamaParse emits markdown)
+HEADING_RE = re.compile(r"^(?=#{1,6} )", re.MULTILINE)
+
+def _quantized_onnx_file() -> str:
+    """Pick the int8-quantized ONNX export of MiniLM that matches this CPU."""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "onnx/model_qint8_arm64.onnx"
+    return "onnx/model_quint8_avx2.onnx"
+
+def _build_embed_model() -> HuggingFaceEmbedding:
+    """
+    Load MiniLM for the best available hardware: FP16 PyTorch on a CUDA GPU,
+    otherwise the int8 ONNX Runtime export on CPU. Embeddings are L2-normalized
+    so that inner product equals cosine similarity.
+    """
+    if torch.cuda.is_available():
+        return HuggingFaceEmbedding(
+            model_name="sentence-transformers/all-MiniLM-L6-v2",
+            cache_folder="./cache",
+            embed_batch_size=128,
+            normalize=True,
+            device="cuda",
+            model_kwargs={"torch_dtype": torch.float16}
+        )
+    # ONNX Runtime ships with sentence-transformers[onnx]; only the CPU path needs it
+    import onnxruntime as ort
+    session_options = ort.SessionOptions()
+    session_options.intra_op_num_threads = os.cpu_count() or 0
+    return HuggingFaceEmbedding(
+        model_name="sentence-transformers/all-MiniLM-L6-v2",
+        cache_folder="./cache",
+        embed_batch_size=64,
+        normalize=True,
+        device="cpu",
+        backend="onnx",
+        model_kwargs={"file_name": _quantized_onnx_file(), "session_options": session_options}
+    )
 
 class RagAgent:
     def __init__(self):
@@ -32,36 +87,19 @@ class RagAgent:
         if not self.gemini_api_key:
             raise ValueError("GEMINI_API_KEY not found in environment variables")
             
-        # Initialize embedding model
-        self.embed_model = HuggingFaceEmbedding(
-            model_name="sentence-transformers/all-MiniLM-L6-v2",
-            cache_folder="./cache"
-        )
-        
         # Configure Gemini
         genai.configure(api_key=self.gemini_api_key)
         self.gemini_model = genai.GenerativeModel('gemini-2.0-flash-exp')
         
-        # Create data directory if it doesn't exist
-        os.makedirs("./data/chroma", exist_ok=True)
-        
-        # Initialize ChromaDB with persistent storage
-        self.chroma_client = chromadb.PersistentClient(path="./data/chroma")
+        # The embedding model, ChromaDB client and LlamaParse client are
+        # created on first use (see the cached properties below)
         
-        # Initialize LlamaParse for document parsing
-        self.parser = LlamaParse(
-            api_key=self.llama_api_key,
-            result_type="markdown",
-            output_tables_as_HTML=True,  # Better table handling
-            complemental_formatting_instruction="Extract and preserve document structure, including headers, lists, and tables. Maintain original formatting where possible.",
-            content_guideline_instruction="Focus on extracting main content, preserve table structures, and maintain document hierarchy. Include all relevant text and data."
-        )
-        
-        # Initialize text splitter
+        # Initialize text splitter, used for sections larger than one chunk
         self.text_splitter = TokenTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP
         )
+        self.tokenizer = get_tokenizer()
         
         # Supported document types
         self.supported_mimes = {
@@ -91,11 +129,46 @@ class RagAgent:
             'application/javascript': '.js',
             'text/javascript': '.js'
         }
+        
+        # Every extension guess_type maps to a supported MIME type (e.g. both .jpg
+        # and .jpeg), i.e. what the MIME check used to accept
+        if not mimetypes.inited:
+            mimetypes.init()
+        self._supported_exts = frozenset(self.supported_mimes.values()).union(
+            ext for ext, mime in mimetypes.types_map.items() if mime in self.supported_mimes
+        )
+
+    @functools.cached_property
+    def embed_model(self) -> HuggingFaceEmbedding:
+        """Embedding model, loaded on first use."""
+        return _build_embed_model()
+
+    @functools.cached_property
+    def _embed_query(self):
+        """Query embedding with reuse for repeated and follow-up questions."""
+        return functools.lru_cache(maxsize=256)(self.embed_model.get_text_embedding)
+
+    @functools.cached_property
+    def chroma_client(self):
+        """ChromaDB client with persistent storage, opened on first use."""
+        # Create data directory if it doesn't exist
+        os.makedirs("./data/chroma", exist_ok=True)
+        return chromadb.PersistentClient(path="./data/chroma")
 
-    def is_supported_file(self, file_content: bytes, filename: str) -> bool:
-        """Check if the file type is supported."""
-        mime_type, _ = mimetypes.guess_type(filename)
-        return mime_type in self.supported_mimes if mime_type else False
+    @functools.cached_property
+    def parser(self) -> LlamaParse:
+        """LlamaParse client for document parsing, created on first use."""
+        return LlamaParse(
+            api_key=self.llama_api_key,
+            result_type="markdown",
+            output_tables_as_HTML=True,  # Better table handling
+            complemental_formatting_instruction="Extract and preserve document structure, including headers, lists, and tables. Maintain original formatting where possible.",
+            content_guideline_instruction="Focus on extracting main content, preserve table structures, and maintain document hierarchy. Include all relevant text and data."
+        )
+
+    def is_supported_file(self, filename: str) -> bool:
+        """Check if the file type is supported, from the filename alone."""
+        return os.path.splitext(filename)[1].lower() in self._supported_exts
 
     async def process_document(self, file_content: bytes, filename: str, session_id: str) -> Dict:
         """
@@ -111,7 +184,7 @@ class RagAgent:
         """
         try:
             # 1. Validate file type
-            if not self.is_supported_file(file_content, filename):
+            if not self.is_supported_file(filename):
                 raise ValueError(f"Unsupported file type: {filename}")
             
             # 2. Parse document
@@ -129,19 +202,37 @@ class RagAgent:
             print(f"Error processing document: {str(e)}")
             raise
 
+    @staticmethod
+    def _is_plain_text(filename: str, mime_type: Optional[str]) -> bool:
+        """Whether a file can be read as text without LlamaParse."""
+        if os.path.splitext(filename)[1].lower() in PLAIN_TEXT_EXTENSIONS:
+            return True
+        if not mime_type or mime_type in PARSED_TEXT_MIMES:
+            return False
+        return mime_type.startswith("text/") or mime_type in PLAIN_TEXT_MIMES
+
     async def _parse_document(self, file_content: bytes, filename: str) -> Dict:
         """Internal method to parse document using LlamaParse."""
         try:
-            # Save temporary file
-            temp_filename = f"temp_{filename}"
-            with open(temp_filename, "wb") as f:
-                f.write(file_content)
-            
-            # Parse document using LlamaParse with async method
-            documents = await self.parser.aload_data(temp_filename)
+            file_type = mimetypes.guess_type(filename)[0]
+            
+            # Plain text and code need no parsing service
+            if self._is_plain_text(filename, file_type):
+                return {
+                    "content": file_content.decode("utf-8", errors="replace"),
+                    "metadata": {
+                        "file_type": file_type,
+                        "filename": filename,
+                        "parse_timestamp": str(datetime.datetime.now()),
+                        "has_tables": False
+                    }
+                }
             
-            # Clean up temp file
-            os.remove(temp_filename)
+            # Parse the in-memory upload with LlamaParse (no temporary file)
+            documents = await self.parser.aload_data(
+                file_content,
+                extra_info={"file_name": filename}
+            )
             
             if not documents:
                 raise Exception("No content extracted from document")
@@ -154,7 +245,7 @@ class RagAgent:
                 "content": parsed_content.text,
                 "metadata": {
                     **parsed_content.metadata,
-                    "file_type": mimetypes.guess_type(filename)[0],
+                    "file_type": file_type,
                     "filename": filename,
                     "parse_timestamp": str(datetime.datetime.now()),
                     "has_tables": "<table" in parsed_content.text  # Check if HTML tables are present
@@ -170,24 +261,29 @@ class RagAgent:
         Prepare parsed document for RAG processing.
         - Takes LlamaParse output
         - Chunks the text while preserving context
-        - Generates embeddings for chunks
         - Maintains metadata
+        Embeddings are generated while storing, see _store_in_chroma.
         """
         try:
             # Extract text content from LlamaParse output
             content = parsed_data.get('content', '')
             metadata = parsed_data.get('metadata', {})
             
-            # Create chunks using the text splitter
-            chunks = self.text_splitter.split_text(content)
+            # LlamaParse output is markdown; locally read files only when they are .md
+            filename = metadata.get('filename', '')
+            file_type = metadata.get('file_type')
+            is_markdown = (
+                os.path.splitext(filename)[1].lower() in MARKDOWN_EXTENSIONS
+                or file_type == 'text/markdown'
+                or not self._is_plain_text(filename, file_type)
+            )
             
-            # Generate embeddings for chunks
-            embeddings = await self._generate_embeddings(chunks)
+            # Create chunks using the text splitter
+            chunks = await asyncio.to_thread(self._split_text, content, is_markdown)
             
             # Prepare processed data
             processed_data = {
                 'chunks': chunks,
-                'embeddings': embeddings,
                 'metadata': metadata,
                 'total_chunks': len(chunks)
             }
@@ -198,7 +294,50 @@ class RagAgent:
             print(f"Error in _prepare_for_rag: {str(e)}")
             raise
 
-    async def _generate_embeddings(self, chunks: List[str]) -> List[np.ndarray]:
+    def _split_text(self, content: str, is_markdown: bool = True) -> List[str]:
+        """
+        Split markdown into chunks that follow the document's heading structure.
+        
+        Sections are merged greedily until the next one would exceed CHUNK_SIZE
+        tokens; a single section larger than that is split by the token splitter.
+        Text shorter than MIN_CHUNK_SIZE is never emitted alone: it is carried into
+        the next section, or folded into the previous chunk at the end.
+        Non-markdown text (e.g. code, where '# ' starts a comment) is not split
+        on headings.
+        """
+        sections = HEADING_RE.split(content) if is_markdown else [content]
+        chunks = []
+        buffer, buffer_tokens = [], 0
+        for section in sections:
+            if not section.strip():
+                continue
+            section_tokens = len(self.tokenizer(section))
+            
+            if buffer and buffer_tokens + section_tokens > CHUNK_SIZE:
+                if buffer_tokens < MIN_CHUNK_SIZE:
+                    # Too short to stand alone, so it leads into this section instead
+                    section = "".join(buffer) + section
+                    section_tokens += buffer_tokens
+                else:
+                    chunks.append("".join(buffer).strip())
+                buffer, buffer_tokens = [], 0
+            
+            if section_tokens > CHUNK_SIZE:
+                chunks.extend(self.text_splitter.split_text(section))
+            else:
+                buffer.append(section)
+                buffer_tokens += section_tokens
+        
+        if buffer:
+            tail = "".join(buffer).strip()
+            if chunks and buffer_tokens < MIN_CHUNK_SIZE:
+                chunks[-1] = f"{chunks[-1]}\n\n{tail}"
+            else:
+                chunks.append(tail)
+        
+        return chunks
+
+    async def _generate_embeddings(self, chunks: List[str]) -> np.ndarray:
         """
         Generate embeddings for text chunks using HuggingFace model.
         
@@ -206,61 +345,115 @@ class RagAgent:
             chunks: List of text chunks to generate embeddings for
             
         Returns:
-            List of numpy arrays containing embeddings
+            Array of shape (len(chunks), embedding_dim) containing embeddings
         """
         try:
-            # Generate embeddings for all chunks
-            embeddings = []
-            for chunk in chunks:
-                # Get embedding for single chunk
-                embedding = self.embed_model.get_text_embedding(
-                    text=chunk,
-                )
-                embeddings.append(embedding)
+            # Encode with the underlying SentenceTransformer: it length-sorts the
+            # whole input before batching and returns one contiguous array, which
+            # avoids llama-index's ndarray -> list of lists round trip
+            embeddings = await asyncio.to_thread(self._encode, chunks)
             
-            return embeddings
+            return np.ascontiguousarray(embeddings, dtype=np.float32)
             
         except Exception as e:
             print(f"Error generating embeddings: {str(e)}")
             raise
 
+    def _encode(self, chunks: List[str]) -> np.ndarray:
+        """Encode chunks synchronously (run via asyncio.to_thread, so a first-use model load stays off the event loop)."""
+        return self.embed_model._model.encode(
+            chunks,
+            batch_size=self.embed_model.embed_batch_size,
+            normalize_embeddings=self.embed_model.normalize,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+
     def get_supported_extensions(self) -> List[str]:
         """Get list of supported file extensions."""
-        return list(set(self.supported_mimes.values()))
+        return sorted(self._supported_exts)
 
     async def _store_in_chroma(self, processed_data: Dict, session_id: str, filename: str):
-        """Store processed document data in ChromaDB."""
+        """
+        Embed processed chunks and store them in ChromaDB.
+        
+        Embedding and upserting are pipelined in groups of INGEST_BATCH_SIZE:
+        the next group is embedded while the previous one is written, with at
+        most two embedded groups waiting in memory.
+        """
         try:
-            # Delete existing collection for this session if it exists
-            try:
-                self.chroma_client.delete_collection(name=f"session_{session_id}")
-            except:
-                pass  # Collection might not exist
-            
-            # Create new collection
-            collection = self.chroma_client.create_collection(
-                name=f"session_{session_id}",
-                metadata={"filename": filename}
+            # Reuse the session collection so re-uploads only touch changed chunks.
+            # Embeddings are normalized, so inner product ranks like cosine.
+            # (chroma_client is read inside the worker so a first-use open stays off the loop)
+            collection = await asyncio.to_thread(
+                lambda: self.chroma_client.get_or_create_collection(
+                    name=f"session_{session_id}",
+                    metadata={"hnsw:space": "ip"}
+                )
             )
             
-            # Generate unique IDs for chunks
-            chunk_ids = [str(uuid.uuid4()) for _ in processed_data['chunks']]
-            
-            # Prepare metadata for each chunk
-            metadatas = [{
-                "chunk_index": idx,
+            # Deterministic IDs from source, content and occurrence count,
+            # so identical chunks map to the same ID across re-uploads
+            chunk_ids = []
+            occurrences: Dict[str, int] = {}
+            for chunk in processed_data['chunks']:
+                n = occurrences.get(chunk, 0)
+                occurrences[chunk] = n + 1
+                key = f"{filename}\0{n}\0{chunk}".encode("utf-8")
+                chunk_ids.append(hashlib.blake2b(key, digest_size=16).hexdigest())
+            
+            # Prepare metadata for each chunk: document-level fields are built once,
+            # each chunk only adds its index
+            base_metadata = {
                 "total_chunks": processed_data['total_chunks'],
                 "source": filename,
                 **processed_data['metadata']
-            } for idx in range(len(processed_data['chunks']))]
-            
-            # Add data to collection
-            collection.add(
-                ids=chunk_ids,
-                embeddings=processed_data['embeddings'],
-                documents=processed_data['chunks'],
-                metadatas=metadatas
-            )
+            }
+            metadatas = [
+                {**base_metadata, "chunk_index": idx}
+                for idx in range(len(processed_data['chunks']))
+            ]
+            
+            chunks = processed_data['chunks']
+            queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+            # Embedding of each distinct chunk text seen so far in this document
+            embedded: Dict[str, np.ndarray] = {}
+            
+            async def embed_groups():
+                for start in range(0, len(chunks), INGEST_BATCH_SIZE):
+                    group = chunks[start:start + INGEST_BATCH_SIZE]
+                    # Repeated boilerplate (headers, footers, ...) is only embedded once
+                    new_chunks = [chunk for chunk in dict.fromkeys(group) if chunk not in embedded]
+                    if new_chunks:
+                        embedded.update(zip(new_chunks, await self._generate_embeddings(new_chunks)))
+                    await queue.put((start, np.stack([embedded[chunk] for chunk in group])))
+                await queue.put(None)
+            
+            async def upload_groups():
+                while (item := await queue.get()) is not None:
+                    start, embeddings = item
+                    end = start + len(embeddings)
+                    await asyncio.to_thread(
+                        collection.upsert,
+                        ids=chunk_ids[start:end],
+                        embeddings=embeddings,
+                        documents=chunks[start:end],
+                        metadatas=metadatas[start:end]
+                    )
+            
+            # TaskGroup cancels the other side if either one fails
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    tg.create_task(embed_groups())
+                    tg.create_task(upload_groups())
+            except ExceptionGroup as eg:
+                raise eg.exceptions[0]
+            
+            # Drop chunks left over from a previous version of this file
+            existing = await asyncio.to_thread(collection.get, where={"source": filename}, include=[])
+            stale_ids = list(set(existing['ids']) - set(chunk_ids))
+            if stale_ids:
+                await asyncio.to_thread(collection.delete, ids=stale_ids)
             
         except Exception as e:
             print(f"Error storing in ChromaDB: {str(e)}")
@@ -269,14 +462,20 @@ class RagAgent:
     async def get_relevant_context(self, query: str, session_id: str, n_results: int = 3) -> List[str]:
         """Get relevant document chunks for a query."""
         try:
-            # Get collection for session
-            collection = self.chroma_client.get_collection(name=f"session_{session_id}")
-            
-            # Generate embedding for query
-            query_embedding = self.embed_model.get_text_embedding(query)
+            # Look up the session collection while the query is embedded. The lazy
+            # properties are read inside the workers so first-use loads stay off the loop.
+            try:
+                collection, query_embedding = await asyncio.gather(
+                    asyncio.to_thread(lambda: self.chroma_client.get_collection(name=f"session_{session_id}")),
+                    asyncio.to_thread(lambda: self._embed_query(query))
+                )
+            except NotFoundError:
+                # No document has been uploaded in this session yet
+                return []
             
             # Query collection
-            results = collection.query(
+            results = await asyncio.to_thread(
+                collection.query,
                 query_embeddings=[query_embedding],
                 n_results=n_results
             )
@@ -288,7 +487,7 @@ class RagAgent:
             print(f"Error getting relevant context: {str(e)}")
             raise
 
-    async def answer_question(self, question: str, session_id: str) -> str:
+    async def answer_question(self, question: str, session_id: str) -> AsyncGenerator[str, None]:
         """
         Answer a question using RAG with Gemini model.
         
@@ -296,15 +495,16 @@ class RagAgent:
             question (str): User's question
             session_id (str): Session identifier
             
-        Returns:
-            str: Generated answer
+        Yields:
+            str: Answer chunks as Gemini generates them
         """
         try:
             # Get relevant context
             context_chunks = await self.get_relevant_context(question, session_id)
             
             if not context_chunks:
-                return "I don't have enough context to answer that question. Please make sure a document is uploaded first."
+                yield "I don't have enough context to answer that question. Please make sure a document is uploaded first."
+                return
             
             # Combine context chunks
             context = "\n\n".join(context_chunks)
@@ -319,10 +519,13 @@ class RagAgent:
             Question: {question}
             """
             
-            # Use Gemini model
-            response = await self.gemini_model.generate_content_async(prompt)
-            return response.text
+            # Stream the answer from Gemini
+            response = await self.gemini_model.generate_content_async(prompt, stream=True)
+            
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
             
         except Exception as e:
             print(f"Error answering question: {str(e)}")
-            raise
+            yield f"Error answering question: {str(e)}"
@@ -1,8 +1,13 @@
 import google.generativeai as genai
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Dict, Optional
 import os
+import time
 import aiohttp
-import json
+import orjson
+
+# Tavily results are reused for identical queries within this window
+SEARCH_CACHE_TTL = 300  # seconds
+SEARCH_CACHE_MAX_SIZE = 1024
 
 class WebAgent:
     def __init__(self):
@@ -19,10 +24,64 @@ class WebAgent:
         genai.configure(api_key=gemini_api_key)
         self.model = genai.GenerativeModel('gemini-2.0-flash-exp')
         
+        # Pooled HTTP session, created on first use and reused across queries
+        self._session: Optional[aiohttp.ClientSession] = None
+        
+        # Recent search results keyed by (normalized query, num_results)
+        self._search_cache: Dict[tuple[str, int], tuple[float, list[str]]] = {}
+        
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            # AsyncResolver (aiodns) keeps DNS lookups off the default thread pool
+            connector = aiohttp.TCPConnector(
+                resolver=aiohttp.AsyncResolver(),
+                limit=32,
+                limit_per_host=8,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+        return self._session
+        
+    async def aclose(self):
+        """Close the shared HTTP session"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        
+    async def __aenter__(self):
+        self._get_session()
+        return self
+        
+    async def __aexit__(self, *exc):
+        await self.aclose()
+        
+    def _cache_search_results(self, key: tuple[str, int], results: list[str]):
+        """Store search results, evicting expired and then oldest entries when full"""
+        now = time.monotonic()
+        self._search_cache.pop(key, None)
+        if len(self._search_cache) >= SEARCH_CACHE_MAX_SIZE:
+            expired = [k for k, (ts, _) in self._search_cache.items() if now - ts > SEARCH_CACHE_TTL]
+            for k in expired:
+                del self._search_cache[k]
+        if len(self._search_cache) >= SEARCH_CACHE_MAX_SIZE:
+            del self._search_cache[next(iter(self._search_cache))]
+        self._search_cache[key] = (now, results)
+        
     async def search_and_scrape(self, query: str, num_results: int = 5) -> list[str]:
         """
         Search using Tavily API - optimized for AI agents
         """
+        cache_key = (query.strip().lower(), num_results)
+        cached = self._search_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] <= SEARCH_CACHE_TTL:
+            print(f"\nUsing cached Tavily results for: {query}")
+            return cached[1]
+            
         try:
             # Tavily API endpoint
             url = "https://api.tavily.com/search"
@@ -38,36 +97,37 @@ class WebAgent:
             
             print(f"\nSearching Tavily for: {query}")
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=params) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        
-                        results = []
-                        
-                        # Add Tavily's generated answer if available
-                        if "answer" in data and data["answer"]:
-                            results.append(f"Summary: {data['answer']}\n")
-                        
-                        # Process search results
-                        if "results" in data:
-                            for result in data["results"]:
-                                title = result.get("title", "No title")
-                                url = result.get("url", "No URL")
-                                content = result.get("content", "No content")
-                                
-                                print(f"\nFound result: {title}")
-                                print(f"URL: {url}")
-                                
-                                results.append(f"Source: {url}\nTitle: {title}\n\n{content}")
-                        
-                        return results
-                    else:
-                        error_data = await response.json()
-                        error_msg = f"Tavily API error: {error_data.get('error', 'Unknown error')}"
-                        print(error_msg)
-                        return []
-                        
+            session = self._get_session()
+            async with session.post(url, json=params) as response:
+                if response.status == 200:
+                    data = orjson.loads(await response.read())
+                    
+                    results = []
+                    
+                    # Add Tavily's generated answer if available
+                    if "answer" in data and data["answer"]:
+                        results.append(f"Summary: {data['answer']}\n")
+                    
+                    # Process search results
+                    if "results" in data:
+                        for result in data["results"]:
+                            title = result.get("title", "No title")
+                            url = result.get("url", "No URL")
+                            content = result.get("content", "No content")
+                            
+                            print(f"\nFound result: {title}")
+                            print(f"URL: {url}")
+                            
+                            results.append(f"Source: {url}\nTitle: {title}\n\n{content}")
+                    
+                    self._cache_search_results(cache_key, results)
+                    return results
+                else:
+                    error_data = orjson.loads(await response.read())
+                    error_msg = f"Tavily API error: {error_data.get('error', 'Unknown error')}"
+                    print(error_msg)
+                    return []
+                    
         except Exception as e:
             print(f"Error during Tavily search: {str(e)}")
             return []
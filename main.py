@@ -16,12 +16,21 @@ import json
 import asyncio
 from typing import Dict, Optional
 from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
 
 # Load environment variables
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Release pooled HTTP sessions on shutdown
+    if web_agent is not None:
+        await web_agent.aclose()
+    await LocalAgent.close_shared_session()
+
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -34,6 +43,7 @@ user_sessions: Dict[str, tuple[TextAgent, datetime]] = {}
 local_sessions: Dict[str, tuple[LocalAgent, datetime]] = {}  # Add local sessions dictionary
 rag_agent = RagAgent()  # Initialize RAG agent
 live_agent = LiveAgent()  # Initialize live agent instance
+web_agent: Optional[WebAgent] = None  # Created on first web query and reused afterwards
 
 class ChatMessage(BaseModel):
     message: str = ""
@@ -46,6 +56,13 @@ class ChatMessage(BaseModel):
     audio_data: Optional[str] = None
     image_data: Optional[str] = None
 
+def get_web_agent() -> WebAgent:
+    """Return the shared WebAgent, creating it on first use"""
+    global web_agent
+    if web_agent is None:
+        web_agent = WebAgent()
+    return web_agent
+
 def cleanup_old_sessions():
     """Remove sessions older than 1 hour"""
     current_time = datetime.now()
@@ -74,8 +91,8 @@ async def root(request: Request):
 async def chat(message: ChatMessage):
     try:
         if message.is_web_mode:
-            # Use WebAgent for web search
-            web_agent = WebAgent()
+            # Use the shared WebAgent for web search
+            web_agent = get_web_agent()
             async def generate_response():
                 async for chunk in web_agent.process_web_query(message.message):
                     if chunk.strip():
@@ -93,7 +110,8 @@ async def chat(message: ChatMessage):
             
             async def generate_response():
                 async for chunk in local_agent.get_streaming_response(message.message, message.session_id):
-                    if chunk.strip():
+                    # Tokens arrive unbuffered, so keep whitespace-only ones (newlines matter for markdown)
+                    if chunk:
                         yield json.dumps({"chunk": chunk}, ensure_ascii=False) + "\n"
             return StreamingResponse(generate_response(), media_type="application/x-ndjson")
         elif message.is_video_mode and message.audio_data and message.image_data:
@@ -121,10 +139,10 @@ async def chat(message: ChatMessage):
             )
         elif message.is_rag_mode:
             # Use RAG agent for document Q&A
-            answer = await rag_agent.answer_question(message.message, message.session_id)
-            
             async def generate_response():
-                yield json.dumps({"chunk": answer}, ensure_ascii=False) + "\n"
+                async for chunk in rag_agent.answer_question(message.message, message.session_id):
+                    if chunk.strip():
+                        yield json.dumps({"chunk": chunk}, ensure_ascii=False) + "\n"
                 
             return StreamingResponse(
                 generate_response(),
@@ -162,11 +180,19 @@ async def upload_file(
     session_id: str = Form(...)
 ):
     try:
-        # Read file content
-        file_content = await file.read()
-        
         if not session_id:
             raise ValueError("Session ID is required")
+        
+        # Reject unsupported files before copying the upload into memory
+        # (Starlette has already spooled the multipart body at this point)
+        if not rag_agent.is_supported_file(file.filename or ""):
+            return JSONResponse(
+                content={"status": "error", "message": f"Unsupported file type: {file.filename}"},
+                status_code=400
+            )
+        
+        # Read file content
+        file_content = await file.read()
             
         print(f"Processing upload for session: {session_id}")
         